@@ -1,9 +1,16 @@
+from contextlib import contextmanager
 from pathlib import Path
+from queue import Queue
+import functools
+import os
+import plistlib
 import shutil
 import subprocess
+import sys
+import threading
 import random
 import string
-from typing import Optional, Mapping, Union
+from typing import Any, Dict, Optional, Mapping, Union
 
 StrPath = Union[str, Path]
 
@@ -34,8 +41,9 @@ def run_process(
     return result
 
 
-def rand_str(len: int):
-    result = "".join(random.choices(string.ascii_letters + string.digits, k=len))
+def rand_str(len: int, rng: Optional[random.Random] = None):
+    choices = rng.choices if rng else random.choices
+    result = "".join(choices(string.ascii_letters + string.digits, k=len))
     return result
 
 
@@ -44,12 +52,10 @@ def gen_id(bundle_id: str, seed: str):
     Encode the bundle id into a different but constant id that
     has the same length and is unique based on the provided seed.
     """
-    old_state = random.getstate()
-    random.seed(seed)
+    rng = random.Random(seed)
     parts = bundle_id.split(".")
-    new_parts = map(lambda x: rand_str(len(x)), parts[1:])
+    new_parts = map(lambda x: rand_str(len(x), rng), parts[1:])
     result = ".".join([parts[0], *new_parts])
-    random.setstate(old_state)
     return result
 
 
@@ -69,6 +75,11 @@ def open_xcode(project: Optional[Path] = None):
         return run_process("xed")
 
 
+def restart_xcode(project: Optional[Path] = None):
+    kill_xcode(False)
+    return open_xcode(project)
+
+
 def debug():
     return run_process("./debug.sh", capture=False)
 
@@ -78,6 +89,53 @@ def read_file(file_path: StrPath):
         return f.read()
 
 
+@functools.lru_cache(maxsize=32)
+def _read_plist(path: str, mtime_ns: int, size: int) -> Dict[str, Any]:
+    with open(path, "rb") as f:
+        return plistlib.load(f)
+
+
+def read_plist(file_path: StrPath) -> Dict[str, Any]:
+    """
+    Parse a plist, reusing the previous result while the file is unchanged.
+    The returned dict is shared between callers and must not be modified.
+    """
+    st = os.stat(file_path)
+    return _read_plist(str(file_path), st.st_mtime_ns, st.st_size)
+
+
+def copy_tree(src: StrPath, dest: StrPath):
+    if sys.platform == "darwin":
+        # clone the files instead of copying their contents, which is instant on APFS
+        return run_process("cp", "-c", "-R", str(src), str(dest))
+    else:
+        return shutil.copytree(src, dest)
+
+
+@contextmanager
+def background_remover():
+    """
+    Remove directory trees on a separate thread. Yields a function that queues
+    a path for removal; every queued path is gone once the context exits.
+    """
+    queue: "Queue[Optional[Path]]" = Queue()
+
+    def worker():
+        while True:
+            path = queue.get()
+            if path is None:
+                return
+            shutil.rmtree(path, ignore_errors=True)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        yield queue.put
+    finally:
+        queue.put(None)
+        thread.join()
+
+
 def extract_zip(archive: Path, dest_dir: Path):
     if shutil.which("7z"):
         return run_process("7z", "x", str(archive), "-o" + str(dest_dir))
@@ -1,26 +1,39 @@
 # https://mypy.readthedocs.io/en/stable/runtime_troubles.html#using-classes-that-are-generic-in-stubs-but-not-at-runtime
 from __future__ import annotations
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from subprocess import CompletedProcess, PIPE, Popen, TimeoutExpired
+from subprocess import CalledProcessError, CompletedProcess, PIPE, Popen, STDOUT, TimeoutExpired
 import tempfile
 import shutil
-from typing import Callable, Dict, Optional, NamedTuple, Set
-import re
+import plistlib
+import threading
+import functools
+from typing import Callable, Deque, Dict, List, Optional, NamedTuple, Set
 import os
+import re
+import uuid
 from util import *
 import time
 
 
 def plist_buddy(args: str, plist: Path, check: bool = True, xml: bool = False):
+    return plist_buddy_batch([args], plist, check=check, xml=xml)
+
+
+def plist_buddy_batch(cmds: List[str], plist: Path, check: bool = True, xml: bool = False):
+    # PlistBuddy runs every -c command against a single load of the plist, so batching
+    # avoids spawning a process (and re-parsing the plist) for each edit
     cmd = ["/usr/libexec/PlistBuddy"]
     if xml:
         cmd.append("-x")
+    for args in cmds:
+        cmd.extend(["-c", args])
     return decode_clean(
         run_process(
             *cmd,
-            "-c",
-            args,
             str(plist),
             check=check,
         ).stdout
@@ -38,7 +51,7 @@ def codesign_async(identity: str, component: Path, entitlements: Optional[Path]
     cmd = ["/usr/bin/codesign", "--continue", "-f", "--no-strict", "-s", identity]
     if entitlements:
         cmd.extend(["--entitlements", str(entitlements)])
-    return subprocess.Popen([*cmd, str(component)], stdout=PIPE, stderr=PIPE)
+    return subprocess.Popen([*cmd, str(component)], stdout=PIPE, stderr=STDOUT)
 
 
 def codesign_dump_entitlements(component: Path):
@@ -47,8 +60,17 @@ def codesign_dump_entitlements(component: Path):
     )
 
 
-def binary_replace(pattern: str, f: Path):
-    return run_process("perl", "-p", "-i", "-e", pattern, str(f))
+def byte_replace_many(
+    f: Path, patches: Dict[bytes, bytes], same_length: bool = False, log: Callable[..., object] = print
+):
+    data = f.read_bytes()
+    for old, new in patches.items():
+        # changing the length of a string inside a binary shifts every offset after it
+        if same_length and len(old) != len(new) and old in data:
+            log(f"WARNING: Not patching '{decode_clean(old)}' in {f.name}, replacement has a different length")
+            continue
+        data = data.replace(old, new)
+    f.write_bytes(data)
 
 
 def security_dump_prov(f: Path):
@@ -63,44 +85,122 @@ plist_base = """<?xml version="1.0" encoding="UTF-8"?>
 </plist>
 """
 
-adhoc_options_plist = """<?xml version="1.0" encoding="UTF-8"?>
-<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
-<plist version="1.0">
-<dict>
-	<key>method</key>
-	<string>ad-hoc</string>
-	<key>iCloudContainerEnvironment</key>
-	<string>Production</string>
-</dict>
-</plist>
-"""
-
-
-def exec_retry(name: str, func: Callable[[], CompletedProcess[bytes]]):
-    start_time = time.time()
+removed_entitlements = [
+    # invalid Xcode entitlements
+    "application-identifier",
+    "com.apple.developer.team-identifier",
+    # the original value may be incompatible with the type of certificate, so let Xcode add the right one
+    "get-task-allow",
+    # inapplicable
+    "com.apple.developer.in-app-payments",
+    # special entitlements
+    # https://developer.apple.com/documentation/xcode/preparing-your-app-to-be-the-default-browser-or-email-client
+    "com.apple.developer.mail-client",
+    "com.apple.developer.web-browser",
+    # https://stackoverflow.com/questions/65330175/which-entitlements-are-special-entitlements-how-do-they-work
+    "com.apple.developer.networking.multicast",
+    "com.apple.developer.usernotifications.filtering",
+    "com.apple.developer.usernotifications.critical-alerts",
+    "com.apple.developer.networking.HotspotHelper",
+    "com.apple.managed.vpn.shared",
+    # only valid in app store distribution
+    # https://developer.apple.com/library/archive/qa/qa1830/_index.html
+    "beta-reports-active",
+    # https://developer.apple.com/documentation/carplay/requesting_the_carplay_entitlements
+    "com.apple.developer.carplay-messaging",
+    # https://stackoverflow.com/questions/62726152/provisioning-profile-doesnt-include-the-com-apple-developer-pushkit-unrestricte
+    "com.apple.developer.pushkit.unrestricted-voip",
+    # TODO: possible, but requires more complex parent-child app component relationship
+    # https://developer.apple.com/documentation/app_clips
+    "com.apple.developer.associated-appclip-app-identifiers",
+]
+
+default_entitlements = {
+    "com.apple.developer.icloud-container-environment": "Development",
+    "aps-environment": "development",
+}
+
+adhoc_options_plist = plistlib.dumps({"method": "ad-hoc", "iCloudContainerEnvironment": "Production"})
+
+
+xcode_hang_messages = [b"Waiting for provisioning to update"]
+
+stale_derived_data_errors = re.compile(
+    rb"unable to attach DB|database is locked"
+    rb"|has been modified since the (precompiled header|module file)"
+    rb"|was compiled with module cache path"
+)
+
+
+def exec_retry(
+    name: str,
+    func: Callable[[], CompletedProcess[bytes]],
+    on_hang: Optional[Callable[[], object]] = None,
+    max_attempts: int = 4,
+    log: Callable[..., object] = print,
+):
     last_error: Optional[Exception] = None
-    while time.time() - start_time < 90:
+    for attempt in range(max_attempts):
         try:
             return func()
         except Exception as e:
-            if isinstance(e.__cause__, TimeoutExpired):
-                last_error = e
-                print(f"{name} timed out, retrying")
-            else:
+            cause = e.__cause__
+            if not isinstance(cause, TimeoutExpired):
                 raise e
+            last_error = e
+            if attempt == max_attempts - 1:
+                break
+            outputs = (cause.stdout or b"", cause.stderr or b"")
+            if on_hang and any(message in output for output in outputs for message in xcode_hang_messages):
+                log(f"{name} is stuck waiting for Xcode, restarting it")
+                on_hang()
+            else:
+                delay = min(2**attempt, 8)
+                log(f"{name} timed out, retrying in {delay}s")
+                time.sleep(delay)
     raise Exception(f"{name} timed out too many times") from last_error
 
 
-def xcode_archive(project_dir: Path, scheme_name: str, archive: Path):
+def is_stale_derived_data(e: Exception):
+    cause = e.__cause__
+    if not isinstance(cause, CalledProcessError):
+        return False
+    return any(stale_derived_data_errors.search(output or b"") for output in (cause.stdout, cause.stderr))
+
+
+@contextmanager
+def xcode_session(project_dir: Path):
     # Xcode needs to be open to "cure" hanging issues
     open_xcode(project_dir)
     try:
-        return exec_retry("xcode_archive", lambda: _xcode_archive(project_dir, scheme_name, archive))
+        yield
     finally:
         kill_xcode(True)
 
 
-def _xcode_archive(project_dir: Path, scheme_name: str, archive: Path):
+def xcode_archive(project_dir: Path, scheme_name: str, archive: Path, log: Callable[..., object] = print):
+    try:
+        return exec_retry(
+            "xcode_archive",
+            lambda: _xcode_archive(project_dir, scheme_name, archive),
+            lambda: restart_xcode(project_dir),
+            log=log,
+        )
+    except Exception as e:
+        if not is_stale_derived_data(e):
+            raise e
+        log("Derived data is stale, retrying with a clean build")
+        return exec_retry(
+            "xcode_archive",
+            lambda: _xcode_archive(project_dir, scheme_name, archive, clean=True),
+            lambda: restart_xcode(project_dir),
+            log=log,
+        )
+
+
+def _xcode_archive(project_dir: Path, scheme_name: str, archive: Path, clean: bool = False):
+    # keep build products next to the project, so retries and later components build incrementally
+    derived_data = project_dir.parent.joinpath("DerivedData")
     return run_process(
         "xcodebuild",
         "-allowProvisioningUpdates",
@@ -108,7 +208,9 @@ def _xcode_archive(project_dir: Path, scheme_name: str, archive: Path):
         str(project_dir.resolve()),
         "-scheme",
         scheme_name,
-        "clean",
+        "-derivedDataPath",
+        str(derived_data.resolve()),
+        *(["clean"] if clean else []),
         "archive",
         "-archivePath",
         str(archive.resolve()),
@@ -116,19 +218,18 @@ def _xcode_archive(project_dir: Path, scheme_name: str, archive: Path):
     )
 
 
-def xcode_export(project_dir: Path, archive: Path, export_dir: Path):
-    # Xcode needs to be open to "cure" hanging issues
-    open_xcode(project_dir)
-    try:
-        return exec_retry("xcode_export", lambda: _xcode_export(project_dir, archive, export_dir))
-    finally:
-        kill_xcode(True)
+def xcode_export(project_dir: Path, archive: Path, export_dir: Path, log: Callable[..., object] = print):
+    return exec_retry(
+        "xcode_export",
+        lambda: _xcode_export(project_dir, archive, export_dir),
+        lambda: restart_xcode(project_dir),
+        log=log,
+    )
 
 
 def _xcode_export(project_dir: Path, archive: Path, export_dir: Path):
     options_plist = export_dir.joinpath("options.plist")
-    with open(options_plist, "w") as f:
-        f.write(adhoc_options_plist)
+    options_plist.write_bytes(adhoc_options_plist)
     return run_process(
         "xcodebuild",
         "-allowProvisioningUpdates",
@@ -145,25 +246,38 @@ def _xcode_export(project_dir: Path, archive: Path, export_dir: Path):
     )
 
 
-def dump_prov_entitlements_plist(prov_file: Path, entitlements_plist: Path):
+@functools.lru_cache(maxsize=4)
+def _dump_prov_entitlements(prov_file: str, mtime_ns: int, size: int) -> bytes:
+    # the profile is a CMS blob with the XML plist embedded as-is, so it can be parsed directly
+    data = Path(prov_file).read_bytes()
+    start = data.find(b"<?xml")
+    end = data.find(b"</plist>", start)
+    if start != -1 and end != -1:
+        prov = plistlib.loads(data[start : end + len(b"</plist>")])
+        return plistlib.dumps(prov["Entitlements"])
+
     with tempfile.TemporaryDirectory() as tmpdir_str:
         tmpdir = Path(tmpdir_str)
         prov_plist = tmpdir.joinpath("prov.plist")
         with open(prov_plist, "w") as f:
-            s = security_dump_prov(prov_file)
-            f.write(s)
-        with open(entitlements_plist, "w") as f:
-            s = plist_buddy("Print :Entitlements", prov_plist, xml=True)
+            s = security_dump_prov(Path(prov_file))
             f.write(s)
+        return plist_buddy("Print :Entitlements", prov_plist, xml=True).encode()
+
+
+def dump_prov_entitlements_plist(prov_file: Path, entitlements_plist: Path):
+    st = os.stat(prov_file)
+    entitlements_plist.write_bytes(_dump_prov_entitlements(str(prov_file), st.st_mtime_ns, st.st_size))
 
 
 def popen_check(pipe: Popen[bytes]):
+    # drain the output while waiting, otherwise a full pipe buffer blocks the process forever
+    tail: Deque[bytes] = deque(pipe.stdout or [], maxlen=64)
+    pipe.wait()
     if pipe.returncode != 0:
         data = {"message": f"{pipe.args} failed with status code {pipe.returncode}"}
-        if pipe.stdout:
-            data["stdout"] = decode_clean(pipe.stdout.read())
-        if pipe.stderr:
-            data["stderr"] = decode_clean(pipe.stderr.read())
+        if tail:
+            data["output"] = decode_clean(b"".join(tail))
         raise Exception(data)
 
 
@@ -185,7 +299,7 @@ class SignOpts(NamedTuple):
 def sign(opts: SignOpts):
     main_app = next(opts.app_dir.glob("Payload/*.app"))
     main_info_plist = main_app.joinpath("Info.plist")
-    old_main_bundle_id = plist_buddy("Print :CFBundleIdentifier", main_info_plist)
+    old_main_bundle_id = read_plist(main_info_plist)["CFBundleIdentifier"]
     is_distribution = "Distribution" in opts.common_name
 
     if opts.prov_file:
@@ -197,8 +311,10 @@ def sign(opts: SignOpts):
             with tempfile.TemporaryDirectory() as tmpdir_str:
                 entitlements_plist = Path(tmpdir_str).joinpath("entitlements.plist")
                 dump_prov_entitlements_plist(opts.prov_file, entitlements_plist)
-                prov_app_id = plist_buddy("Print :application-identifier", entitlements_plist)
-                main_bundle_id = prov_app_id[prov_app_id.find(".") + 1 :]
+                prov_app_id = read_plist(entitlements_plist)["application-identifier"]
+                # an app id without a team prefix is used as-is
+                head, sep, tail = prov_app_id.partition(".")
+                main_bundle_id = tail if sep else head
                 if "*" in main_bundle_id:
                     print("Provisioning profile is wildcard, using original bundle id")
                     main_bundle_id = old_main_bundle_id
@@ -228,24 +344,44 @@ def sign(opts: SignOpts):
         else:
             f.write(main_bundle_id)
 
-    component_exts = ["*.app", "*.appex", "*.framework", "*.dylib"]
+    component_exts = {".app", ".appex", ".framework", ".dylib"}
+    components: List[Path] = []
+    for dirpath, dirnames, filenames in os.walk(main_app):
+        # these never contain components, so don't bother walking them
+        dirnames[:] = [d for d in dirnames if d not in ["SC_Info", "_CodeSignature"]]
+        components.extend(Path(dirpath, name) for name in dirnames + filenames if Path(name).suffix in component_exts)
     # make sure components are ordered depth-first, otherwise signing will overlap and become invalid
-    components = [item for e in component_exts for item in main_app.glob("**/" + e)][::-1]
+    components.reverse()
     components.append(main_app)
 
     mappings: Dict[str, str] = {}
+    xcode_lock = threading.Lock()
+    print_lock = threading.Lock()
+
+    def component_logger(component: Path):
+        # components are prepared concurrently, so label every line with the component it belongs to
+        prefix = f"[{component.relative_to(main_app.parent)}] "
+
+        def log(*values: object, sep: str = " "):
+            lines = sep.join(map(str, values)).splitlines() or [""]
+            with print_lock:
+                print("".join(f"{prefix}{line}\n" for line in lines), end="", flush=True)
+
+        return log
 
     def sign_secondary(component: Path, workdir: Path):
+        log = component_logger(component)
         # entitlements of frameworks, etc. don't matter, so leave them (potentially) invalid
-        print("Signing with original entitlements")
+        log("Signing with original entitlements")
         return codesign_async(opts.common_name, component)
 
     def sign_primary(component: Path, workdir: Path):
+        log = component_logger(component)
         info_plist = component.joinpath("Info.plist")
         with tempfile.NamedTemporaryFile(dir=workdir, suffix=".plist", delete=False) as f:
             entitlements_plist = Path(f.name)
         embedded_prov = component.joinpath("embedded.mobileprovision")
-        old_bundle_id = plist_buddy("Print :CFBundleIdentifier", info_plist)
+        old_bundle_id = read_plist(info_plist)["CFBundleIdentifier"]
         bundle_id = f"{main_bundle_id}{old_bundle_id[len(old_main_bundle_id):]}"
         component_bin = component.joinpath(component.stem)
 
@@ -255,92 +391,55 @@ def sign(opts: SignOpts):
             # profile, but not when applied to a binary. For example:
             #   com.apple.developer.icloud-services = *
             # Ideally, all such cases should be manually replaced.
-            dump_prov_entitlements_plist(embedded_prov, entitlements_plist)
+            dump_prov_entitlements_plist(opts.prov_file, entitlements_plist)
 
-            prov_app_id = plist_buddy("Print :application-identifier", entitlements_plist)
+            prov_app_id = read_plist(entitlements_plist)["application-identifier"]
             component_app_id = f"{opts.team_id}.{bundle_id}"
             if prov_app_id == component_app_id or "*" in prov_app_id:
                 plist_buddy(f"Set :application-identifier {component_app_id}", entitlements_plist)
             else:
-                print(
+                log(
                     f"WARNING: Provisioning profile's app id '{prov_app_id}' does not match component's app id '{component_app_id}'.",
                     "Using provisioning profile's app id - the component will run, but its entitlements will be broken!",
                     sep="\n",
                 )
         else:
-            with tempfile.TemporaryDirectory() as tmpdir_str:
-                tmpdir = Path(tmpdir_str)
-                simple_app_dir = tmpdir.joinpath("SimpleApp")
-                shutil.copytree("SimpleApp", simple_app_dir)
-                xcode_entitlements_plist = simple_app_dir.joinpath("SimpleApp/SimpleApp.entitlements")
+            with tempfile.TemporaryDirectory(dir=workdir) as outdir_str:
+                outdir = Path(outdir_str)
+                xcode_entitlements_plist = outdir.joinpath("SimpleApp.entitlements")
                 with open(xcode_entitlements_plist, "w") as f:
                     try:
                         s = codesign_dump_entitlements(component)
                     except:
-                        print("Failed to dump entitlements, using empty")
+                        log("Failed to dump entitlements, using empty")
                         s = plist_base
                     f.write(s)
 
+                try:
+                    entitlements = plistlib.loads(xcode_entitlements_plist.read_bytes())
+                except:
+                    log("Failed to parse entitlements")
+                    entitlements = {}
+
                 old_team_ids: Set[str] = set()
                 try:
-                    old_team_ids.add(
-                        plist_buddy("Print :com.apple.developer.team-identifier", xcode_entitlements_plist)
-                    )
+                    old_team_ids.add(entitlements["com.apple.developer.team-identifier"])
                 except:
-                    print("Failed to read old team id from com.apple.developer.team-identifier")
+                    log("Failed to read old team id from com.apple.developer.team-identifier")
                 try:
-                    old_team_ids.add(
-                        plist_buddy("Print :application-identifier", xcode_entitlements_plist).split(".")[0]
-                    )
+                    old_team_ids.add(entitlements["application-identifier"].partition(".")[0])
                 except:
-                    print("Failed to read old team id from application-identifier")
-
-                print("Original entitlements:", read_file(xcode_entitlements_plist), sep="\n")
-
-                for item in [
-                    # invalid Xcode entitlements
-                    "application-identifier",
-                    "com.apple.developer.team-identifier",
-                    # the original value may be incompatible with the type of certificate, so let Xcode add the right one
-                    "get-task-allow",
-                    # inapplicable
-                    "com.apple.developer.in-app-payments",
-                    # special entitlements
-                    # https://developer.apple.com/documentation/xcode/preparing-your-app-to-be-the-default-browser-or-email-client
-                    "com.apple.developer.mail-client",
-                    "com.apple.developer.web-browser",
-                    # https://stackoverflow.com/questions/65330175/which-entitlements-are-special-entitlements-how-do-they-work
-                    "com.apple.developer.networking.multicast",
-                    "com.apple.developer.usernotifications.filtering",
-                    "com.apple.developer.usernotifications.critical-alerts",
-                    "com.apple.developer.networking.HotspotHelper",
-                    "com.apple.managed.vpn.shared",
-                    # only valid in app store distribution
-                    # https://developer.apple.com/library/archive/qa/qa1830/_index.html
-                    "beta-reports-active",
-                    # https://developer.apple.com/documentation/carplay/requesting_the_carplay_entitlements
-                    "com.apple.developer.carplay-messaging",
-                    # https://stackoverflow.com/questions/62726152/provisioning-profile-doesnt-include-the-com-apple-developer-pushkit-unrestricte
-                    "com.apple.developer.pushkit.unrestricted-voip",
-                    # TODO: possible, but requires more complex parent-child app component relationship
-                    # https://developer.apple.com/documentation/app_clips
-                    "com.apple.developer.associated-appclip-app-identifiers",
-                ]:
-                    plist_buddy(
-                        f"Delete :{item}",
-                        xcode_entitlements_plist,
-                        check=False,
-                    )
+                    log("Failed to read old team id from application-identifier")
 
-                for entitlement, value in {
-                    "com.apple.developer.icloud-container-environment": "Development",
-                    "aps-environment": "development",
-                }.items():
-                    plist_buddy(
-                        f"Set :{entitlement} {value}",
-                        xcode_entitlements_plist,
-                        check=False,
-                    )
+                log("Original entitlements:", read_file(xcode_entitlements_plist), sep="\n")
+
+                for item in removed_entitlements:
+                    entitlements.pop(item, None)
+
+                # only override existing entitlements, adding them would require extra capabilities
+                for entitlement, value in default_entitlements.items():
+                    if entitlement in entitlements:
+                        entitlements[entitlement] = value
 
                 patches: Dict[str, str] = {}
 
@@ -353,30 +452,15 @@ def sign(opts: SignOpts):
                     ),
                     ("com.apple.developer.ubiquity-container-identifiers", "iCloud.", []),
                 ):
-                    try:
-                        remap_ids = plist_buddy(
-                            "Print :" + entitlement,
-                            xcode_entitlements_plist,
-                        )
-                    except:
-                        remap_ids = ""
-
-                    remap_ids = [remap_id.strip()[len(prefix) :] for remap_id in remap_ids.splitlines()[1:-1]]
+                    remap_ids = [remap_id.strip()[len(prefix) :] for remap_id in entitlements.get(entitlement, [])]
                     if len(remap_ids) < 1:
                         # some features like iCloud only work with Xcode if they have identifiers defined
                         # make sure such cases are fixed if necessary
                         for parent in parents:
-                            try:
-                                # check if entitlement exists
-                                plist_buddy(
-                                    "Print :" + parent,
-                                    xcode_entitlements_plist,
-                                )
+                            if parent in entitlements:
                                 # add a default identifier
                                 remap_ids.append(bundle_id)
                                 break
-                            except:
-                                continue
 
                     if len(remap_ids) < 1:
                         continue
@@ -392,135 +476,173 @@ def sign(opts: SignOpts):
                             else:
                                 mappings[remap_id] = remap_id
 
-                    plist_buddy(
-                        "Delete :" + entitlement,
-                        xcode_entitlements_plist,
-                        check=False,
-                    )
-                    plist_buddy(
-                        f"Add :{entitlement} array",
-                        xcode_entitlements_plist,
-                    )
-
-                    for i, remap_id in enumerate(remap_ids):
-                        plist_buddy(
-                            f"Add :{entitlement}:{i} string '{prefix+mappings[remap_id]}'",
-                            xcode_entitlements_plist,
-                        )
+                    entitlements[entitlement] = [prefix + mappings[remap_id] for remap_id in remap_ids]
+                    for remap_id in remap_ids:
                         patches[prefix + remap_id] = prefix + mappings[remap_id]
 
+                xcode_entitlements_plist.write_bytes(plistlib.dumps(entitlements))
+
                 for old_team_id in old_team_ids:
                     patches[old_team_id] = opts.team_id
                 patches[old_bundle_id] = bundle_id
                 patches[old_main_bundle_id] = main_bundle_id
 
-                print("Applying patches...")
+                log("Applying patches...")
                 targets = [xcode_entitlements_plist]
                 if opts.patch_ids:
                     targets.append(component_bin)
                     targets.append(info_plist)
                 else:
-                    print("Skipping component binary")
+                    log("Skipping component binary")
+                # replace longer ids first, so ids that contain shorter ones aren't patched halfway
+                patches_bytes = {
+                    old.encode(): new.encode() for old, new in sorted(patches.items(), key=lambda x: -len(x[0]))
+                }
                 for target in targets:
-                    for old, new in patches.items():
-                        binary_replace(f"s/{re.escape(old)}/{re.escape(new)}/g", target)
+                    byte_replace_many(target, patches_bytes, same_length=target == component_bin, log=log)
 
-                print("Patched entitlements:", read_file(xcode_entitlements_plist), sep="\n")
+                log("Patched entitlements:", read_file(xcode_entitlements_plist), sep="\n")
 
+                simple_app_dir = workdir.joinpath("SimpleApp")
                 simple_app_proj = simple_app_dir.joinpath("SimpleApp.xcodeproj")
                 simple_app_pbxproj = simple_app_proj.joinpath("project.pbxproj")
-                binary_replace(f"s/BUNDLE_ID_HERE_V9KP12/{bundle_id}/g", simple_app_pbxproj)
-                binary_replace(f"s/DEV_TEAM_HERE_J8HK5C/{opts.team_id}/g", simple_app_pbxproj)
-
-                for prov_profile in get_prov_profiles():
-                    os.remove(prov_profile)
-
-                print("Obtaining provisioning profile...")
-                print("Archiving app...")
-                archive = simple_app_dir.joinpath("archive.xcarchive")
-                xcode_archive(simple_app_proj, "SimpleApp", archive)
-                if is_distribution:
-                    print("Exporting app...")
+
+                # Xcode, the project and the provisioning profiles directory are shared by every component
+                with xcode_lock:
+                    shutil.copyfile(
+                        xcode_entitlements_plist, simple_app_dir.joinpath("SimpleApp/SimpleApp.entitlements")
+                    )
+                    shutil.copyfile("SimpleApp/SimpleApp.xcodeproj/project.pbxproj", simple_app_pbxproj)
+                    byte_replace_many(
+                        simple_app_pbxproj,
+                        {b"BUNDLE_ID_HERE_V9KP12": bundle_id.encode(), b"DEV_TEAM_HERE_J8HK5C": opts.team_id.encode()},
+                    )
+
                     for prov_profile in get_prov_profiles():
                         os.remove(prov_profile)
-                    xcode_export(simple_app_proj, archive, simple_app_dir)
-                    exported_ipa = simple_app_dir.joinpath("SimpleApp.ipa")
-                    extract_zip(exported_ipa, simple_app_dir)
-                    output_bin = simple_app_dir.joinpath("Payload/SimpleApp.app")
-                else:
-                    output_bin = archive.joinpath("Products/Applications/SimpleApp.app")
 
-                prov_profiles = list(get_prov_profiles())
-                shutil.move(str(prov_profiles[0]), embedded_prov)
-                for prov_profile in prov_profiles[1:]:
-                    os.remove(prov_profile)
-                with open(entitlements_plist, "w") as f:
-                    f.write(codesign_dump_entitlements(output_bin))
+                    log("Obtaining provisioning profile...")
+                    log("Archiving app...")
+                    archive = outdir.joinpath("archive.xcarchive")
+                    with xcode_session(simple_app_proj):
+                        xcode_archive(simple_app_proj, "SimpleApp", archive, log=log)
+                        if is_distribution:
+                            log("Exporting app...")
+                            for prov_profile in get_prov_profiles():
+                                os.remove(prov_profile)
+                            xcode_export(simple_app_proj, archive, outdir, log=log)
+                            exported_ipa = outdir.joinpath("SimpleApp.ipa")
+                            extract_zip(exported_ipa, outdir)
+                            output_bin = outdir.joinpath("Payload/SimpleApp.app")
+                        else:
+                            output_bin = archive.joinpath("Products/Applications/SimpleApp.app")
+
+                    prov_profiles = list(get_prov_profiles())
+                    shutil.move(str(prov_profiles[0]), embedded_prov)
+                    for prov_profile in prov_profiles[1:]:
+                        os.remove(prov_profile)
+                    with open(entitlements_plist, "w") as f:
+                        f.write(codesign_dump_entitlements(output_bin))
 
         if opts.force_original_id:
-            print("Keeping original CFBundleIdentifier")
+            log("Keeping original CFBundleIdentifier")
             plist_buddy(f"Set :CFBundleIdentifier {old_bundle_id}", info_plist)
         else:
-            print(f"Setting CFBundleIdentifier to {bundle_id}")
+            log(f"Setting CFBundleIdentifier to {bundle_id}")
             plist_buddy(f"Set :CFBundleIdentifier {bundle_id}", info_plist)
 
         plist_buddy("Delete :get-task-allow", entitlements_plist, check=False)
         if opts.patch_debug:
             plist_buddy("Add :get-task-allow bool true", entitlements_plist)
-            print("Enabled app debugging")
+            log("Enabled app debugging")
         else:
-            print("Disabled app debugging")
+            log("Disabled app debugging")
 
         if opts.patch_all_devices:
-            print("Force enabling support for all devices")
-            plist_buddy("Delete :UISupportedDevices", info_plist, check=False)
-            # https://developer.apple.com/library/archive/documentation/General/Reference/InfoPlistKeyReference/Articles/iPhoneOSKeys.html
-            plist_buddy("Delete :UIDeviceFamily", info_plist, check=False)
-            plist_buddy("Add :UIDeviceFamily array", info_plist)
-            plist_buddy("Add :UIDeviceFamily:0 integer 1", info_plist)
-            plist_buddy("Add :UIDeviceFamily:1 integer 2", info_plist)
+            log("Force enabling support for all devices")
+            plist_buddy_batch(
+                [
+                    "Delete :UISupportedDevices",
+                    # https://developer.apple.com/library/archive/documentation/General/Reference/InfoPlistKeyReference/Articles/iPhoneOSKeys.html
+                    "Delete :UIDeviceFamily",
+                ],
+                info_plist,
+                check=False,
+            )
+            plist_buddy_batch(
+                [
+                    "Add :UIDeviceFamily array",
+                    "Add :UIDeviceFamily:0 integer 1",
+                    "Add :UIDeviceFamily:1 integer 2",
+                ],
+                info_plist,
+            )
 
         if opts.patch_file_sharing:
-            print("Force enabling file sharing")
-            plist_buddy("Delete :UIFileSharingEnabled", info_plist, check=False)
-            plist_buddy("Add :UIFileSharingEnabled bool true", info_plist)
-            plist_buddy("Delete :UISupportsDocumentBrowser", info_plist, check=False)
-            plist_buddy("Add :UISupportsDocumentBrowser bool true", info_plist)
-
-        print("Signing with entitlements:", read_file(entitlements_plist), sep="\n")
+            log("Force enabling file sharing")
+            plist_buddy_batch(
+                ["Delete :UIFileSharingEnabled", "Delete :UISupportsDocumentBrowser"],
+                info_plist,
+                check=False,
+            )
+            plist_buddy_batch(
+                ["Add :UIFileSharingEnabled bool true", "Add :UISupportsDocumentBrowser bool true"],
+                info_plist,
+            )
+
+        log("Signing with entitlements:", read_file(entitlements_plist), sep="\n")
         return codesign_async(opts.common_name, component, entitlements_plist)
 
-    with tempfile.TemporaryDirectory() as tmpdir_str:
-        tmpdir = Path(tmpdir_str)
-        jobs: Dict[Path, subprocess.Popen[bytes]] = {}
-        for component in components:
-            print(f"Preparing component {component}")
-
-            for path in list(jobs.keys()):
-                pipe = jobs[path]
-                try:
-                    path.relative_to(component)
-                except:
-                    continue
-                if pipe.poll() is None:
-                    print("Waiting for sub-component to finish signing:", path)
-                    pipe.wait()
-                popen_check(pipe)
-                jobs.pop(path)
-
-            print("Processing")
-
-            sc_info = component.joinpath("SC_Info")
-            if sc_info.exists():
-                print(f"Removing leftover AppStore data")
+    def sign_component(component: Path, workdir: Path):
+        log = component_logger(component)
+        log(f"Preparing component {component}")
+
+        sc_info = component.joinpath("SC_Info")
+        if sc_info.exists():
+            log(f"Removing leftover AppStore data")
+            # move it out of the way so signing doesn't have to wait for the removal
+            trash = workdir.joinpath(f"sc_{uuid.uuid4()}")
+            try:
+                os.rename(sc_info, trash)
+                remove_later(trash)
+            except OSError:
                 shutil.rmtree(sc_info)
 
-            if component.suffix in [".appex", ".app"]:
-                jobs[component] = sign_primary(component, tmpdir)
-            else:
-                jobs[component] = sign_secondary(component, tmpdir)
-
-        print("Waiting for any remaining components to finish signing")
-        for pipe in jobs.values():
-            pipe.wait()
-            popen_check(pipe)
+        if component.suffix in [".appex", ".app"]:
+            pipe = sign_primary(component, workdir)
+        else:
+            pipe = sign_secondary(component, workdir)
+        popen_check(pipe)
+
+    with tempfile.TemporaryDirectory() as tmpdir_str, background_remover() as remove_later:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            tmpdir = Path(tmpdir_str)
+            if opts.prov_file is None:
+                # one copy of the project is reused by every component, so Xcode can reuse its build products
+                copy_tree("SimpleApp", tmpdir.joinpath("SimpleApp"))
+
+            jobs: Dict[Path, Future[None]] = {}
+            try:
+                for component in components:
+                    for path in list(jobs.keys()):
+                        try:
+                            path.relative_to(component)
+                        except:
+                            continue
+                        job = jobs.pop(path)
+                        if not job.done():
+                            with print_lock:
+                                print("Waiting for sub-component to finish signing:", path)
+                        job.result()
+
+                    jobs[component] = executor.submit(sign_component, component, tmpdir)
+
+                with print_lock:
+                    print("Waiting for any remaining components to finish signing")
+                for job in jobs.values():
+                    job.result()
+            except BaseException:
+                # fail fast, don't keep preparing components that haven't started yet
+                for job in jobs.values():
+                    job.cancel()
+                raise